@@ -1,10 +1,14 @@
 """A nendo plugin for audio effects mostly based on pedalboard by Spotify's Audio Intelligence Lab."""
+import numbers
+import threading
+from functools import lru_cache
 from logging import Logger
-from typing import Any, Optional, Tuple
+from types import MappingProxyType
+from typing import Any, Dict, List, Optional, Tuple, Type
 
 import numpy as np
 import pedalboard
-from nendo import Nendo, NendoConfig, NendoEffectPlugin
+from nendo import Nendo, NendoConfig, NendoEffectPlugin, NendoPluginRuntimeError
 from pedalboard import (
     Chorus,
     Compressor,
@@ -19,6 +23,146 @@ from pedalboard import (
     Phaser,
     Reverb,
 )
+from pedalboard.io import AudioFile
+
+
+# 20 * log10(x) expressed via log2
+_DB_SCALE = 20.0 / np.log2(10.0)
+
+# parameter values at which an effect leaves the signal untouched
+_BYPASS_MIX = 0.0
+_BYPASS_WET_LEVEL = 0.0
+_BYPASS_RATIO = 1.0
+_BYPASS_REVERB_DRY_LEVEL = 0.5  # pedalboard scales the reverb dry level by 2
+
+# read-only registry of the pedalboard effects used by name throughout the plugin
+_EFFECTS = MappingProxyType(
+    {
+        "reverb": Reverb,
+        "distortion": Distortion,
+        "phaser": Phaser,
+        "delay": Delay,
+        "chorus": Chorus,
+        "compressor": Compressor,
+        "limiter": Limiter,
+        "highpass": HighpassFilter,
+        "lowpass": LowpassFilter,
+        "low_shelf": LowShelfFilter,
+        "high_shelf": HighShelfFilter,
+    },
+)
+
+# an effect class together with its parameters as hashable (name, value) pairs
+_EffectSpec = Tuple[Type[pedalboard.Plugin], Tuple[Tuple[str, Any], ...]]
+
+
+@lru_cache(maxsize=None)
+def _effect_params(effect_cls: Type[pedalboard.Plugin]) -> Tuple[str, ...]:
+    """Get the names of the settable parameters of a pedalboard effect."""
+    return tuple(
+        sorted(
+            name
+            for name in dir(effect_cls)
+            if isinstance(getattr(effect_cls, name), property)
+            and getattr(effect_cls, name).fset is not None
+        ),
+    )
+
+
+def _build_chain(effects: List[Tuple[str, Dict[str, Any]]]) -> Tuple[_EffectSpec, ...]:
+    """Resolve (effect name, parameters) pairs into a hashable effect chain."""
+    chain = []
+    for entry in effects:
+        try:
+            name, params = entry
+        except (TypeError, ValueError):
+            name = params = None
+        if not isinstance(name, str) or not isinstance(params, dict):
+            raise NendoPluginRuntimeError(
+                f"Invalid effect {entry!r}, expected an (effect name, parameters) pair.",
+            )
+        if name not in _EFFECTS:
+            raise NendoPluginRuntimeError(
+                f"Unknown effect '{name}', choose from: {', '.join(_EFFECTS)}.",
+            )
+        valid_params = _effect_params(_EFFECTS[name])
+        for key, value in params.items():
+            if key not in valid_params:
+                raise NendoPluginRuntimeError(
+                    f"Unknown parameter '{key}' for effect '{name}', "
+                    f"choose from: {', '.join(valid_params)}.",
+                )
+            if not isinstance(value, numbers.Real) or isinstance(value, bool):
+                raise NendoPluginRuntimeError(
+                    f"Invalid value {value!r} for parameter '{key}' of effect "
+                    f"'{name}', expected a number.",
+                )
+        chain.append((_EFFECTS[name], tuple(sorted(params.items()))))
+    return tuple(chain)
+
+
+def _make_board(chain: Tuple[_EffectSpec, ...]) -> Pedalboard:
+    """Build a pedalboard for a chain of effects."""
+    return Pedalboard([effect_cls(**dict(params)) for effect_cls, params in chain])
+
+
+# boards hold processing state, so every thread keeps its own cache of them
+_thread_local = threading.local()
+
+
+def _get_board(chain: Tuple[_EffectSpec, ...]) -> Pedalboard:
+    """Get a pedalboard for a chain of effects from the calling thread's cache."""
+    get_board = getattr(_thread_local, "get_board", None)
+    if get_board is None:
+        get_board = _thread_local.get_board = lru_cache(maxsize=128)(_make_board)
+    return get_board(chain)
+
+
+def _channels_equal(a: np.ndarray, b: np.ndarray, chunk: int = 4096) -> bool:
+    """Compare two channels bit by bit in chunks, stopping at the first mismatch."""
+    if a.shape != b.shape or a.dtype != b.dtype:
+        return False
+    # compare float samples as unsigned integers of the same width, which is
+    # an exact bitwise check without any NaN or signed zero special cases
+    if a.dtype.kind == "f" and a.flags.c_contiguous and b.flags.c_contiguous:
+        uint = np.dtype(f"u{a.dtype.itemsize}")
+        a, b = a.view(uint), b.view(uint)
+    for i in range(0, a.shape[0], chunk):
+        if not np.array_equal(a[i : i + chunk], b[i : i + chunk]):
+            return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def _warm_up() -> None:
+    """Run a short silent block through pedalboard once per process.
+
+    This moves pedalboard's one-time setup out of the first effect call.
+    """
+    silence = np.zeros((2, 1024), dtype=np.float32)
+    Pedalboard([Reverb(), Compressor(), Limiter()])(silence, 44100)
+
+
+def _as_float32(signal: np.ndarray) -> np.ndarray:
+    """Return the signal as a C-contiguous float32 array, copying only if needed."""
+    if signal.dtype != np.float32 or not signal.flags.c_contiguous:
+        return np.ascontiguousarray(signal, dtype=np.float32)
+    return signal
+
+
+def _haas_kernel(left: np.ndarray, right: np.ndarray, delay: int) -> np.ndarray:
+    """Build a two-channel signal with a delayed and inverted left channel.
+
+    Every output sample is written exactly once: the right channel is copied,
+    the leading ``delay`` samples of the left channel are zeroed and the rest
+    is negated straight into the output buffer. The output is float32, so any
+    conversion of the input happens as part of that same write.
+    """
+    out = np.empty((2, left.shape[0]), dtype=np.float32)
+    out[1] = right
+    out[0, :delay] = 0.0
+    np.negative(left[:-delay], out=out[0, delay:])
+    return out
 
 
 class NendoFxCore(NendoEffectPlugin):
@@ -28,7 +172,6 @@ class NendoFxCore(NendoEffectPlugin):
         nendo_instance (Nendo): The instance of Nendo using this plugin.
         config (NendoConfig): The configuration of the Nendo instance.
         logger (Logger): The logger to use for reporting.
-        board (Pedalboard): The pedalboard instance to use for chaining effects.
 
     Examples:
         ```python
@@ -53,12 +196,11 @@ class NendoFxCore(NendoEffectPlugin):
     nendo_instance: Nendo = None
     config: NendoConfig = None
     logger: Logger = None
-    board: Pedalboard = None
 
     def __init__(self, **data: Any):
         """Initialize the plugin."""
         super().__init__(**data)
-        self.board = Pedalboard()
+        _warm_up()
 
     @NendoEffectPlugin.run_signal
     def reverb(
@@ -87,15 +229,19 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        reverb = Reverb(
-            wet_level=wet_level,
-            dry_level=dry_level,
-            room_size=room_size,
-            damping=damping,
-            width=width,
-            freeze_mode=freeze_mode,
+        # without a wet signal the reverb only passes the (scaled) dry signal
+        if wet_level == _BYPASS_WET_LEVEL and dry_level == _BYPASS_REVERB_DRY_LEVEL:
+            return _as_float32(signal), sr
+
+        params = (
+            ("wet_level", wet_level),
+            ("dry_level", dry_level),
+            ("room_size", room_size),
+            ("damping", damping),
+            ("width", width),
+            ("freeze_mode", freeze_mode),
         )
-        return self._append_and_run(reverb, signal, sr)
+        return self._run_effect("reverb", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def distortion(
@@ -114,8 +260,8 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        distortion = Distortion(drive_db=drive_db)
-        return self._append_and_run(distortion, signal, sr)
+        params = (("drive_db", drive_db),)
+        return self._run_effect("distortion", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def phaser(
@@ -142,14 +288,18 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        phaser = Phaser(
-            rate_hz=rate_hz,
-            depth=depth,
-            centre_frequency_hz=centre_frequency_hz,
-            feedback=feedback,
-            mix=mix,
+        # a fully dry mix leaves the signal untouched
+        if mix == _BYPASS_MIX:
+            return _as_float32(signal), sr
+
+        params = (
+            ("rate_hz", rate_hz),
+            ("depth", depth),
+            ("centre_frequency_hz", centre_frequency_hz),
+            ("feedback", feedback),
+            ("mix", mix),
         )
-        return self._append_and_run(phaser, signal, sr)
+        return self._run_effect("phaser", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def delay(
@@ -172,8 +322,16 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        delay = Delay(delay_seconds=delay_seconds, feedback=feedback, mix=mix)
-        return self._append_and_run(delay, signal, sr)
+        # a fully dry mix leaves the signal untouched
+        if mix == _BYPASS_MIX:
+            return _as_float32(signal), sr
+
+        params = (
+            ("delay_seconds", delay_seconds),
+            ("feedback", feedback),
+            ("mix", mix),
+        )
+        return self._run_effect("delay", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def chorus(
@@ -200,14 +358,18 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        chorus = Chorus(
-            rate_hz=rate_hz,
-            depth=depth,
-            centre_delay_ms=centre_delay_ms,
-            feedback=feedback,
-            mix=mix,
+        # a fully dry mix leaves the signal untouched
+        if mix == _BYPASS_MIX:
+            return _as_float32(signal), sr
+
+        params = (
+            ("rate_hz", rate_hz),
+            ("depth", depth),
+            ("centre_delay_ms", centre_delay_ms),
+            ("feedback", feedback),
+            ("mix", mix),
         )
-        return self._append_and_run(chorus, signal, sr)
+        return self._run_effect("chorus", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def compressor(
@@ -232,13 +394,17 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        compressor = Compressor(
-            threshold_db=threshold_db,
-            ratio=ratio,
-            attack_ms=attack_ms,
-            release_ms=release_ms,
+        # a ratio of 1 applies no gain reduction above any threshold
+        if ratio == _BYPASS_RATIO:
+            return _as_float32(signal), sr
+
+        params = (
+            ("threshold_db", threshold_db),
+            ("ratio", ratio),
+            ("attack_ms", attack_ms),
+            ("release_ms", release_ms),
         )
-        return self._append_and_run(compressor, signal, sr)
+        return self._run_effect("compressor", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def stereo(self, signal: np.ndarray, sr: int) -> Tuple[np.ndarray, int]:
@@ -246,7 +412,8 @@ class NendoFxCore(NendoEffectPlugin):
 
         https://en.wikipedia.org/wiki/Precedence_effect
 
-        When given a stereo signal the function will just return the original signal.
+        When given a stereo or multichannel signal or a signal shorter than the
+        delay of 150 ms, the function will just return the original signal.
 
         Args:
             signal (np.ndarray): The audio signal to process.
@@ -255,21 +422,27 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
+        delay_offset = int(sr * 0.15)  # 150 ms
+
+        # signals that do not outlast the delay would end up with a silent channel
+        if signal.shape[-1] <= delay_offset:
+            return _as_float32(signal), sr
+
+        # use views of the mono channel instead of duplicating it up front,
+        # the kernel writes both output channels in a single pass
         if signal.ndim == 1:
-            signal = np.stack([signal, signal])
+            left = right = signal
         elif signal.shape[0] == 1:
-            signal = np.repeat(signal, 2, axis=0)
-
-        # ignore already stereo signals
-        elif np.array_equal(signal[0], signal[1]):
-            return signal, sr
+            left = right = signal[0]
 
-        delay_offset = int(sr * 0.15)  # 15 ms
-        haas_signal = np.roll(signal, shift=delay_offset, axis=0)
-        haas_signal[0, :delay_offset] = 0.0
-        haas_signal[0, :] *= -1
+        # only dual-mono stereo is widened, real stereo and any other channel
+        # count is returned as is
+        elif signal.shape[0] == 2 and _channels_equal(signal[0], signal[1]):
+            left, right = signal[0], signal[1]
+        else:
+            return _as_float32(signal), sr
 
-        return haas_signal, sr
+        return _haas_kernel(left, right, delay_offset), sr
 
     @NendoEffectPlugin.run_signal
     def limiter(
@@ -290,17 +463,24 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        limiter = Limiter(release_ms=release_ms)
-
         # adaptive limiting
         if threshold_db is None:
-            peak_amp = np.max(20 * np.log10(np.abs(signal)))
-            threshold = peak_amp - 0.1
-            limiter.threshold_db = threshold
-        else:
-            limiter.threshold_db = threshold_db
-
-        return self._append_and_run(limiter, signal, sr)
+            # convert up front so the peak search already reads float32
+            signal = _as_float32(signal)
+            # reduce to the linear peak first so the log runs on a single scalar
+            peak_lin = max(signal.max(), -signal.min())
+            # there is nothing to limit in silence, and a threshold derived
+            # from it would make the limiter's makeup gain blow up the output
+            if peak_lin == 0:
+                return signal, sr
+            peak_amp = _DB_SCALE * np.log2(peak_lin)
+            threshold_db = peak_amp - 0.1
+
+        params = (
+            ("threshold_db", threshold_db),
+            ("release_ms", release_ms),
+        )
+        return self._run_effect("limiter", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def highpass(
@@ -319,8 +499,8 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        eq = HighpassFilter(cutoff_frequency_hz=cutoff_frequency_hz)
-        return self._append_and_run(eq, signal, sr)
+        params = (("cutoff_frequency_hz", cutoff_frequency_hz),)
+        return self._run_effect("highpass", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def lowpass(
@@ -339,8 +519,8 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        eq = LowpassFilter(cutoff_frequency_hz=cutoff_frequency_hz)
-        return self._append_and_run(eq, signal, sr)
+        params = (("cutoff_frequency_hz", cutoff_frequency_hz),)
+        return self._run_effect("lowpass", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def low_shelf(
@@ -363,12 +543,12 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        eq = LowShelfFilter(
-            cutoff_frequency_hz=cutoff_frequency_hz,
-            gain_db=gain_db,
-            q=q,
+        params = (
+            ("cutoff_frequency_hz", cutoff_frequency_hz),
+            ("gain_db", gain_db),
+            ("q", q),
         )
-        return self._append_and_run(eq, signal, sr)
+        return self._run_effect("low_shelf", params, signal, sr)
 
     @NendoEffectPlugin.run_signal
     def high_shelf(
@@ -391,21 +571,102 @@ class NendoFxCore(NendoEffectPlugin):
         Returns:
             Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
         """
-        eq = HighShelfFilter(
-            cutoff_frequency_hz=cutoff_frequency_hz,
-            gain_db=gain_db,
-            q=q,
+        params = (
+            ("cutoff_frequency_hz", cutoff_frequency_hz),
+            ("gain_db", gain_db),
+            ("q", q),
         )
-        return self._append_and_run(eq, signal, sr)
+        return self._run_effect("high_shelf", params, signal, sr)
+
+    @NendoEffectPlugin.run_signal
+    def process_chain(
+        self,
+        signal: np.ndarray,
+        sr: int,
+        effects: List[Tuple[str, Dict[str, Any]]],
+    ) -> Tuple[np.ndarray, int]:
+        """Apply a chain of effects to a track or a collection in a single pass.
+
+        All effects are run inside one pedalboard, which streams the signal
+        through the whole chain block by block. This is preferred over calling
+        the single effect functions one after another.
+        Parameters that are not given fall back to pedalboard's defaults.
+
+        Args:
+            signal (np.ndarray): The audio signal to process.
+            sr (int): The sample rate of the audio signal.
+            effects (List[Tuple[str, Dict[str, Any]]]): The effects to apply in order,
+                given as pairs of effect name (e.g. "reverb") and its parameters.
+
+        Returns:
+            Tuple[np.ndarray, int]: The processed audio signal and the sample rate.
+        """
+        return self._run_chain(_build_chain(effects), signal, sr)
+
+    def process_stream(
+        self,
+        path_in: str,
+        path_out: str,
+        effects: List[Tuple[str, Dict[str, Any]]],
+        block_size: int = 65536,
+    ) -> None:
+        """Apply a chain of effects to an audio file block by block.
+
+        Only one block of audio is held in memory at a time, which makes this
+        suitable for long recordings. The effect state is carried over between
+        blocks, so the processed samples are the same as processing the whole
+        file at once.
+
+        WAV output is written as 32-bit float, which keeps those samples intact,
+        including any that exceed full scale. Other formats (e.g. FLAC, MP3) use
+        pedalboard's default encoding for them, which quantizes the output and
+        clips anything above full scale.
+
+        Args:
+            path_in (str): The path of the audio file to read.
+            path_out (str): The path of the audio file to write.
+            effects (List[Tuple[str, Dict[str, Any]]]): The effects to apply in order,
+                given as pairs of effect name (e.g. "reverb") and its parameters.
+            block_size (int, optional): The number of samples to read per block.
+                Defaults to 65536.
+        """
+        board = _get_board(_build_chain(effects))
+        board.reset()
+        # only WAV supports float samples, see the docstring
+        write_kwargs = {"bit_depth": 32} if path_out.lower().endswith(".wav") else {}
+        with AudioFile(path_in) as f_in, AudioFile(
+            path_out,
+            "w",
+            samplerate=f_in.samplerate,
+            num_channels=f_in.num_channels,
+            **write_kwargs,
+        ) as f_out:
+            while f_in.tell() < f_in.frames:
+                block = f_in.read(block_size)
+                f_out.write(board.process(block, f_in.samplerate, reset=False))
+
+    def _run_effect(
+        self,
+        name: str,
+        params: Tuple[Tuple[str, Any], ...],
+        signal: np.ndarray,
+        sr: int,
+    ) -> Tuple[np.ndarray, int]:
+        """Run the signal through the cached pedalboard for the given effect."""
+        return self._run_chain(((_EFFECTS[name], params),), signal, sr)
 
-    def _append_and_run(
+    def _run_chain(
         self,
-        effect: pedalboard.Plugin,
+        chain: Tuple[_EffectSpec, ...],
         signal: np.ndarray,
         sr: int,
     ) -> Tuple[np.ndarray, int]:
-        """Append an effect to the pedalboard and run it on the signal."""
-        self.board.append(effect)
-        output_audio = self.board(input_array=signal, sample_rate=sr)
-        self.board.reset()
+        """Run the signal through the cached pedalboard for the given chain."""
+        # pedalboard processes float32, convert once here instead of letting
+        # it cast (and copy) float64 or strided input internally
+        signal = _as_float32(signal)
+        board = _get_board(chain)
+        # the board resets its internal state before processing, so a cached
+        # board can be reused without leaking tails from the previous call
+        output_audio = board(input_array=signal, sample_rate=sr)
         return output_audio, sr
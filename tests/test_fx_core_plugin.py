@@ -1,140 +1,315 @@
 # -*- encoding: utf-8 -*-
 """Tests for the Nendo FxCore plugin."""
+import os
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from nendo import Nendo, NendoConfig, NendoError
-
-nd = Nendo(
-    config=NendoConfig(
-        library_path="./library",
-        log_level="INFO",
-        plugins=["nendo_plugin_fx_core"],
-    )
-)
+from nendo_plugin_fx_core import NendoFxCore
+from pedalboard.io import AudioFile
 
 
 class FxCorePluginTest(unittest.TestCase):
-    def test_run_reverb(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
+    @classmethod
+    def setUpClass(cls):
+        cls.nd = Nendo(
+            config=NendoConfig(
+                library_path="./library",
+                log_level="INFO",
+                plugins=["nendo_plugin_fx_core"],
+            )
+        )
+        # add and decode the test file once, the track caches its signal so
+        # the effects below all reuse the decoded audio
+        cls.nd.library.reset(force=True)
+        cls.track = cls.nd.library.add_track(file_path="tests/assets/test.wav")
+        cls.signal, cls.sr = cls.track.signal, cls.track.sr
 
-        reverb_track = nd.plugins.fx_core.reverb(
-            track=track,
+    def _run_signal(self, name, signal, sr=None, **kwargs):
+        """Call an effect on a raw signal, bypassing the track wrapper."""
+        plugin = self.nd.plugins.fx_core.plugin_instance
+        func = getattr(NendoFxCore, name).__wrapped__
+        return func(plugin, signal, sr or self.sr, **kwargs)
+
+    def test_run_reverb(self):
+        reverb_track = self.nd.plugins.fx_core.reverb(
+            track=self.track,
         )
-        self.assertEqual(reverb_track.sr, track.sr)
+        self.assertEqual(reverb_track.sr, self.track.sr)
 
     def test_run_process_reverb_throws_exception(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-        self.assertRaises(NendoError, track.process, "nendo_plugin_fx_core")
+        self.assertRaises(NendoError, self.track.process, "nendo_plugin_fx_core")
 
     def test_run_process_reverb_collection_throws_exception(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-        collection = nd.library.add_collection(
+        collection = self.nd.library.add_collection(
             name="test_collection",
-            track_ids=[track.id],
+            track_ids=[self.track.id],
         )
         self.assertRaises(NendoError, collection.process, "nendo_plugin_fx_core")
 
-    def test_run_distortion(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
+    def _assert_bypassed(self, name, **kwargs):
+        signal = self.signal.astype(np.float64)
+        bypassed, sr = self._run_signal(name, signal, **kwargs)
+        self.assertEqual(sr, self.sr)
+        self.assertEqual(bypassed.dtype, np.float32)
+        np.testing.assert_array_equal(bypassed, self.signal)
 
-        distortion_track = nd.plugins.fx_core.distortion(
-            track=track,
+    def test_reverb_without_wet_level_is_bypassed(self):
+        self._assert_bypassed("reverb", wet_level=0.0, dry_level=0.5)
+
+    def test_phaser_without_mix_is_bypassed(self):
+        self._assert_bypassed("phaser", mix=0.0)
+
+    def test_delay_without_mix_is_bypassed(self):
+        self._assert_bypassed("delay", mix=0.0)
+
+    def test_chorus_without_mix_is_bypassed(self):
+        self._assert_bypassed("chorus", mix=0.0)
+
+    def test_compressor_with_unity_ratio_is_bypassed(self):
+        self._assert_bypassed("compressor", ratio=1.0, threshold_db=-20.0)
+
+    def test_run_distortion(self):
+        distortion_track = self.nd.plugins.fx_core.distortion(
+            track=self.track,
         )
-        self.assertEqual(distortion_track.sr, track.sr)
+        self.assertEqual(distortion_track.sr, self.track.sr)
 
     def test_run_chorus(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-
-        chorus_track = nd.plugins.fx_core.chorus(
-            track=track,
+        chorus_track = self.nd.plugins.fx_core.chorus(
+            track=self.track,
         )
-        self.assertEqual(chorus_track.sr, track.sr)
+        self.assertEqual(chorus_track.sr, self.track.sr)
 
     def test_run_phaser(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-
-        phaser_track = nd.plugins.fx_core.phaser(
-            track=track,
+        phaser_track = self.nd.plugins.fx_core.phaser(
+            track=self.track,
         )
-        self.assertEqual(phaser_track.sr, track.sr)
+        self.assertEqual(phaser_track.sr, self.track.sr)
 
     def test_run_delay(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-
-        delay_track = nd.plugins.fx_core.delay(
-            track=track,
+        delay_track = self.nd.plugins.fx_core.delay(
+            track=self.track,
         )
-        self.assertEqual(delay_track.sr, track.sr)
+        self.assertEqual(delay_track.sr, self.track.sr)
 
     def test_run_compressor(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-
-        compressor_track = nd.plugins.fx_core.compressor(
-            track=track,
+        compressor_track = self.nd.plugins.fx_core.compressor(
+            track=self.track,
         )
-        self.assertEqual(compressor_track.sr, track.sr)
+        self.assertEqual(compressor_track.sr, self.track.sr)
 
     def test_run_stereo(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-
-        stereo_track = nd.plugins.fx_core.stereo(
-            track=track,
+        # the test file is already stereo, so widen a dual-mono copy of it
+        mono = self.signal[0]
+        dual_mono_track = self.nd.library.add_track_from_signal(
+            np.stack([mono, mono]),
+            self.sr,
+        )
+        stereo_track = self.nd.plugins.fx_core.stereo(
+            track=dual_mono_track,
+        )
+        self.assertEqual(stereo_track.sr, dual_mono_track.sr)
+        self.assertFalse(
+            np.array_equal(stereo_track.signal[0], stereo_track.signal[1]),
         )
-        self.assertEqual(stereo_track.sr, track.sr)
 
-    def test_run_limiter(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
+    def _assert_haas(self, stereo, mono, sr):
+        d = int(sr * 0.15)
+        self.assertEqual(stereo.shape, (2, mono.shape[0]))
+        np.testing.assert_array_equal(stereo[0, :d], 0.0)
+        np.testing.assert_array_equal(stereo[0, d:], -mono[:-d])
+        np.testing.assert_array_equal(stereo[1], mono)
+
+    def test_stereo_mono_signal(self):
+        mono = self.signal[0]
+        stereo, sr = self._run_signal("stereo", mono)
+        self._assert_haas(stereo, mono, sr)
+
+    def test_stereo_single_channel_signal(self):
+        mono = self.signal[0]
+        stereo, sr = self._run_signal("stereo", mono[np.newaxis, :])
+        self._assert_haas(stereo, mono, sr)
+
+    def test_stereo_dual_mono_signal(self):
+        mono = self.signal[0]
+        stereo, sr = self._run_signal("stereo", np.stack([mono, mono]))
+        self._assert_haas(stereo, mono, sr)
+
+    def test_stereo_stereo_signal_unchanged(self):
+        stereo, sr = self._run_signal("stereo", self.signal.astype(np.float64))
+        self.assertEqual(sr, self.sr)
+        self.assertEqual(stereo.dtype, np.float32)
+        np.testing.assert_array_equal(stereo, self.signal)
 
-        limiter_track = nd.plugins.fx_core.limiter(
-            track=track,
+    def test_stereo_multichannel_signal_unchanged(self):
+        mono = self.signal[0]
+        multichannel = np.stack([mono, mono, self.signal[1]]).astype(np.float64)
+        stereo, sr = self._run_signal("stereo", multichannel)
+        self.assertEqual(sr, self.sr)
+        self.assertEqual(stereo.dtype, np.float32)
+        np.testing.assert_array_equal(stereo, multichannel)
+
+    def test_stereo_short_signal_unchanged(self):
+        short = self.signal[:1, : int(self.sr * 0.15)]
+        stereo, sr = self._run_signal("stereo", short.astype(np.float64))
+        self.assertEqual(sr, self.sr)
+        self.assertEqual(stereo.dtype, np.float32)
+        np.testing.assert_array_equal(stereo, short)
+
+    def test_run_limiter(self):
+        limiter_track = self.nd.plugins.fx_core.limiter(
+            track=self.track,
         )
-        self.assertEqual(limiter_track.sr, track.sr)
+        self.assertEqual(limiter_track.sr, self.track.sr)
 
-    def test_run_highpass(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
+    def test_limiter_silence_returns_silence(self):
+        silence = np.zeros((2, self.sr), dtype=np.float32)
+        limited, sr = self._run_signal("limiter", silence)
+        self.assertEqual(sr, self.sr)
+        np.testing.assert_array_equal(limited, silence)
 
-        highpass_track = nd.plugins.fx_core.highpass(
-            track=track,
+    def test_run_highpass(self):
+        highpass_track = self.nd.plugins.fx_core.highpass(
+            track=self.track,
         )
-        self.assertEqual(highpass_track.sr, track.sr)
+        self.assertEqual(highpass_track.sr, self.track.sr)
 
     def test_run_lowpass(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-
-        lowpass_track = nd.plugins.fx_core.lowpass(
-            track=track,
+        lowpass_track = self.nd.plugins.fx_core.lowpass(
+            track=self.track,
         )
-        self.assertEqual(lowpass_track.sr, track.sr)
+        self.assertEqual(lowpass_track.sr, self.track.sr)
 
     def test_run_low_shelf(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
-
-        low_shelf_track = nd.plugins.fx_core.low_shelf(
-            track=track,
+        low_shelf_track = self.nd.plugins.fx_core.low_shelf(
+            track=self.track,
         )
-        self.assertEqual(low_shelf_track.sr, track.sr)
+        self.assertEqual(low_shelf_track.sr, self.track.sr)
 
     def test_run_high_shelf(self):
-        nd.library.reset(force=True)
-        track = nd.library.add_track(file_path="tests/assets/test.wav")
+        high_shelf_track = self.nd.plugins.fx_core.high_shelf(
+            track=self.track,
+        )
+        self.assertEqual(high_shelf_track.sr, self.track.sr)
+
+    def test_reverb_concurrent_calls_match_serial(self):
+        signals = [self.signal * scale for scale in np.linspace(0.1, 0.8, 8)]
+        serial = [self._run_signal("reverb", signal)[0] for signal in signals]
+        with ThreadPoolExecutor(max_workers=len(signals)) as executor:
+            concurrent = list(
+                executor.map(lambda s: self._run_signal("reverb", s)[0], signals),
+            )
+        for expected, actual in zip(serial, concurrent):
+            np.testing.assert_array_equal(actual, expected)
 
-        high_shelf_track = nd.plugins.fx_core.high_shelf(
-            track=track,
+    def test_run_process_chain(self):
+        chain_track = self.nd.plugins.fx_core.process_chain(
+            track=self.track,
+            effects=[
+                ("compressor", {"threshold_db": -10.0, "ratio": 4.0}),
+                ("reverb", {"wet_level": 0.2, "dry_level": 0.8}),
+                ("limiter", {"threshold_db": -1.0}),
+            ],
         )
-        self.assertEqual(high_shelf_track.sr, track.sr)
+        self.assertEqual(chain_track.sr, self.track.sr)
+
+    def test_run_process_chain_unknown_effect_throws_exception(self):
+        self.assertRaises(
+            NendoError,
+            self.nd.plugins.fx_core.process_chain,
+            track=self.track,
+            effects=[("unknown", {})],
+        )
+
+    def test_run_process_chain_unknown_parameter_throws_exception(self):
+        self.assertRaises(
+            NendoError,
+            self.nd.plugins.fx_core.process_chain,
+            track=self.track,
+            effects=[("reverb", {"unknown": 0.5})],
+        )
+
+    def test_run_process_chain_unhashable_parameter_throws_exception(self):
+        self.assertRaises(
+            NendoError,
+            self.nd.plugins.fx_core.process_chain,
+            track=self.track,
+            effects=[("reverb", {"wet_level": [0.5]})],
+        )
+        self.assertRaises(
+            NendoError,
+            self.nd.plugins.fx_core.process_chain,
+            track=self.track,
+            effects=[("reverb", {"wet_level": "0.5"})],
+        )
+        self.assertRaises(
+            NendoError,
+            self.nd.plugins.fx_core.process_chain,
+            track=self.track,
+            effects=[("reverb", None)],
+        )
+
+    def test_run_process_stream(self):
+        effects = [("reverb", {}), ("delay", {"delay_seconds": 0.1, "feedback": 0.3})]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_path = os.path.join(tmp_dir, "out.wav")
+            self.nd.plugins.fx_core.process_stream(
+                path_in="tests/assets/test.wav",
+                path_out=out_path,
+                effects=effects,
+                block_size=4096,
+            )
+            with AudioFile("tests/assets/test.wav") as f_in, AudioFile(
+                out_path,
+            ) as f_out:
+                self.assertEqual(f_out.samplerate, f_in.samplerate)
+                self.assertEqual(f_out.frames, f_in.frames)
+                signal, sr = f_in.read(f_in.frames), int(f_in.samplerate)
+                streamed = f_out.read(f_out.frames)
+
+        # block-wise processing must match one pass over the whole signal
+        processed, _ = self._run_signal("process_chain", signal, sr, effects=effects)
+        self.assertGreater(np.abs(processed).max(), 1.0)
+        np.testing.assert_allclose(streamed, processed, atol=1e-6)
+
+    def test_process_stream_concurrent_calls_match_serial(self):
+        # every thread streams through the same cached chain without resets
+        # between blocks, so a board shared across threads would mix the state
+        # of the differently scaled signals
+        effects = [("reverb", {}), ("delay", {"delay_seconds": 0.1, "feedback": 0.3})]
+        excerpt = self.signal[:, : self.sr * 5]
+        signals = [excerpt * scale for scale in np.linspace(0.1, 0.8, 8)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            def stream(i):
+                path_in = os.path.join(tmp_dir, f"in_{i}.wav")
+                path_out = os.path.join(tmp_dir, f"out_{i}.wav")
+                with AudioFile(
+                    path_in,
+                    "w",
+                    self.sr,
+                    signals[i].shape[0],
+                    bit_depth=32,
+                ) as f:
+                    f.write(signals[i])
+                self.nd.plugins.fx_core.process_stream(
+                    path_in=path_in,
+                    path_out=path_out,
+                    effects=effects,
+                    block_size=4096,
+                )
+                with AudioFile(path_out) as f:
+                    return f.read(f.frames)
+
+            with ThreadPoolExecutor(max_workers=len(signals)) as executor:
+                streamed = list(executor.map(stream, range(len(signals))))
+
+        for signal, actual in zip(signals, streamed):
+            expected, _ = self._run_signal("process_chain", signal, effects=effects)
+            np.testing.assert_allclose(actual, expected, atol=1e-6)
 
 
 if __name__ == "__main__":